@@ -1,14 +1,26 @@
+import functools
+import json
 import logging
+import os
+import queue
+import re
 import subprocess
+import threading
 import webbrowser
+from concurrent.futures import ThreadPoolExecutor
 from os.path import dirname
 from os.path import isdir
+from os.path import join
 from os.path import relpath
 from sys import stdout
 from typing import Any
+from typing import Callable
 from typing import Dict
+from typing import Iterable
 from typing import List
 from typing import Optional
+from typing import Pattern
+from typing import Tuple
 
 import sublime
 import sublime_plugin
@@ -16,18 +28,30 @@ import sublime_plugin
 PREFERRED_BRANCHES = [
     "master",
     "main",
-    "remotes/origin/master",
-    "remotes/origin/main",
+    "origin/master",
+    "origin/main",
 ]
 
+# Preferred branch => priority (lower is better)
+_PREFERRED_RANK = {b: i for i, b in enumerate(PREFERRED_BRANCHES)}
+
 
 def get_logger(level: int = logging.INFO) -> logging.Logger:
-    logging.basicConfig(
-        level=level,
-        format="[%(name)s:%(levelname)s] [%(filename)s:%(lineno)d]: %(message)s",
-        handlers=[logging.StreamHandler(stdout)],
-    )
-    return logging.getLogger("GitTools")
+    # Configure our own logger instead of calling logging.basicConfig, which
+    # modifies the root logger shared by all plugins.
+    logger = logging.getLogger("GitTools")
+    logger.setLevel(level)
+    # Plugin reloads re-import this module, but the logger is global.
+    if not logger.handlers:
+        handler = logging.StreamHandler(stdout)
+        handler.setFormatter(
+            logging.Formatter(
+                "[%(name)s:%(levelname)s] [%(filename)s:%(lineno)d]: %(message)s"
+            )
+        )
+        logger.addHandler(handler)
+        logger.propagate = False
+    return logger
 
 
 # Global logger
@@ -42,14 +66,6 @@ class UnsupportedURIException(Exception):
         return f"unsupported remote URI: {self.uri}"
 
 
-class UnsupportedHostException(Exception):
-    def __init__(self, uri: str) -> None:
-        self.uri = uri
-
-    def __str__(self) -> str:
-        return f"unsupported remote host: {self.uri}"
-
-
 class RowRange:
     __slots__ = "begin", "end"
 
@@ -58,6 +74,15 @@ class RowRange:
         self.end = end
 
 
+# Pool used to run independent git commands concurrently
+_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="GitTools")
+
+
+def plugin_unloaded() -> None:
+    _POOL.shutdown(wait=False)
+    _close_batch_checks()
+
+
 # TODO: fallback to the commit if we can't find a branch
 class GitBrowse(sublime_plugin.WindowCommand):
     def run(self, **kwargs: Dict[str, Any]) -> None:
@@ -69,27 +94,30 @@ class GitBrowse(sublime_plugin.WindowCommand):
             sublime.status_message("error: GitBrowse: file not saved to disk")
             return
         row_range = view_selection_rows(view)
+        settings = sublime.load_settings("GitTools.sublime-settings")
+        prefer_sha = settings.get("prefer_sha", True)
+
+        # Run git and open the browser on the async thread since both
+        # can block the UI.
+        sublime.set_timeout_async(
+            functools.partial(self.browse, file_name, row_range, prefer_sha), 0
+        )
 
+    def browse(
+        self, file_name: str, row_range: Optional[RowRange], prefer_sha: bool
+    ) -> None:
         # TODO: check if the remote exists in GitHub
-        branch = git_branch(file_name)
-        remote = git_branch_remote_url(file_name, branch)
-        if not remote:
-            resolved_branch = git_commit_branch(file_name, branch)
-            if not resolved_branch:
-                log.info("failed to find a branch for commit %s", branch)
-                return
-            branch = resolved_branch
-            remote = git_branch_remote_url(file_name, branch)
-            if not remote:
-                log.info("failed to find a remote for commit %s", branch)
-                return
+        resolved = resolve_repo(file_name, prefer_sha)
+        if not resolved:
+            sublime.status_message("error: GitBrowse: failed to find a remote")
+            return
+        top_level, ref, base_url = resolved
 
-        base_url = convert_remote_url(remote)
-        rel = repo_relpath(file_name)
-        log.info("relpath: %s branch: %s base_url: %s", rel, branch, base_url)
+        rel = repo_relpath(file_name, top_level)
+        log.info("relpath: %s ref: %s base_url: %s", rel, ref, base_url)
 
         # WARN: this is GitHub specific
-        url = f"{base_url}/blob/{branch}/{rel}"
+        url = f"{base_url}/blob/{ref}/{rel}"
         if row_range:
             # Add "?plain=1" so that we open the code for things like Markdown
             # which by default are opened in a "pretty" view.
@@ -97,6 +125,144 @@ class GitBrowse(sublime_plugin.WindowCommand):
         webbrowser.open(url)
 
 
+# resolve_repo returns the top-level directory of the repo containing path,
+# the ref to browse and the base URL of its remote. The ref is the current
+# commit if prefer_sha is true, otherwise it is the branch.
+def resolve_repo(path: str, prefer_sha: bool) -> Optional[Tuple[str, str, str]]:
+    # Use the persisted result if the repo's HEAD and config are unchanged.
+    # This is the only cache of git output since it is the only one that can
+    # be validated without running git.
+    top_level = _find_repo(path)
+    stamp = _repo_stamp(top_level) if top_level else None
+    if top_level and stamp:
+        entry = _load_repo_cache().get(top_level, {})
+        base_url = entry.get("base_url")
+        if (
+            base_url
+            and entry.get("mtime") == stamp
+            and entry.get("prefer_sha") == prefer_sha
+        ):
+            if prefer_sha:
+                # Commits do not change HEAD so the SHA cannot be persisted.
+                sha = _batch_rev_parse(top_level, "HEAD")
+                if not sha:
+                    sha = git_commit_sha(top_level)
+                return top_level, sha, base_url
+            if entry.get("branch"):
+                return top_level, entry["branch"], base_url
+
+    batch = _POOL.submit(_git_batch, path)
+    config = _POOL.submit(_git_config, path)
+    info = batch.result()
+    if not top_level:
+        top_level = info["top_level"]
+    branch = info["branch"]
+    if prefer_sha:
+        # Permalinks only need a remote, so only resolve the branch if the
+        # remote cannot be found from the config alone.
+        ref = info["commit"]
+        remote = _config_remote_url(config.result(), branch)
+        if not remote:
+            remote = config.result().get("remote.origin.url")
+        if not remote:
+            resolved = resolve_branch_remote(top_level, branch, config.result())
+            if not resolved:
+                return None
+            remote = resolved[1]
+        base_url = convert_remote_url(remote)
+    else:
+        resolved = resolve_branch_remote(top_level, branch, config.result())
+        if not resolved:
+            return None
+        ref, remote = resolved
+        base_url = convert_remote_url(remote)
+
+    if stamp:
+        cache = _load_repo_cache()
+        # Re-insert so that the least recently resolved repo is evicted first.
+        cache.pop(top_level, None)
+        cache[top_level] = {
+            "branch": None if prefer_sha else ref,
+            "base_url": base_url,
+            "prefer_sha": prefer_sha,
+            "mtime": stamp,
+        }
+        while len(cache) > _MAX_REPO_CACHE:
+            del cache[next(iter(cache))]
+        _save_repo_cache()
+    return top_level, ref, base_url
+
+
+# _find_repo returns the top-level directory of the repo containing path
+# without invoking git. None is returned if no ".git" directory is found or
+# if the nearest ".git" is a file (worktrees and submodules).
+def _find_repo(path: str) -> Optional[str]:
+    d = _git_dir(path)
+    while True:
+        git = join(d, ".git")
+        if os.path.lexists(git):
+            return d if isdir(git) else None
+        parent = dirname(d)
+        if parent == d:
+            return None
+        d = parent
+
+
+# _repo_stamp returns the modification times of the HEAD and config files
+# of the repo at top_level, which are used to validate the repo cache.
+def _repo_stamp(top_level: str) -> Optional[List[int]]:
+    try:
+        return [
+            os.stat(join(top_level, ".git", "HEAD")).st_mtime_ns,
+            os.stat(join(top_level, ".git", "config")).st_mtime_ns,
+        ]
+    except OSError:
+        return None
+
+
+# Repo top-level => {"branch": ..., "base_url": ..., "prefer_sha": ...,
+# "mtime": ...} persisted across sessions (see _load_repo_cache).
+_REPO_CACHE: Optional[Dict[str, Dict[str, Any]]] = None
+
+# Maximum number of repos to keep in _REPO_CACHE
+_MAX_REPO_CACHE = 64
+
+
+def _repo_cache_file() -> str:
+    return join(sublime.cache_path(), "GitTools", "repos.json")
+
+
+def _load_repo_cache() -> Dict[str, Dict[str, Any]]:
+    global _REPO_CACHE
+    if _REPO_CACHE is None:
+        try:
+            with open(_repo_cache_file(), encoding="utf-8") as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError(f"expected an object got: {type(data).__name__}")
+            _REPO_CACHE = {k: v for k, v in data.items() if isinstance(v, dict)}
+        except FileNotFoundError:
+            _REPO_CACHE = {}
+        except (OSError, ValueError) as e:
+            log.warning("failed to load repo cache: %s", e)
+            _REPO_CACHE = {}
+    return _REPO_CACHE
+
+
+def _save_repo_cache() -> None:
+    name = _repo_cache_file()
+    try:
+        os.makedirs(dirname(name), exist_ok=True)
+        # Write to a temp file first so that the cache is never left
+        # partially written.
+        tmp = name + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(_load_repo_cache(), f)
+        os.replace(tmp, name)
+    except OSError as e:
+        log.warning("failed to save repo cache: %s", e)
+
+
 def removeprefix(base: str, prefix: str) -> str:
     if base.startswith(prefix):
         return base[len(prefix) :]
@@ -109,35 +275,73 @@ def removesuffix(base: str, suffix: str) -> str:
     return base
 
 
-def format_url(host_url: str, row_range: Optional[RowRange]) -> str:
-    if "github.com" not in host_url:
-        raise UnsupportedHostException(host_url)
-    return ""
+# _normalize_remote strips trailing slashes and the ".git" suffix from remote
+# URL u and lowercases its host so that equivalent URLs share cache entries.
+def _normalize_remote(u: str) -> str:
+    u = removesuffix(removesuffix(u.strip(), "/"), ".git")
+    scheme, sep, rest = u.partition("://")
+    if sep:
+        host, slash, path = rest.partition("/")
+        return f"{scheme}://{host.lower()}{slash}{path}"
+    # scp-like syntax: [user@]host:path
+    host, sep, path = u.partition(":")
+    if sep:
+        return f"{host.lower()}:{path}"
+    return u
 
 
 # TODO: load replacements from settings
 def convert_remote_url(u: str, replacements: Optional[Dict[str, str]] = None) -> str:
-    if u.startswith("https://github.com"):
-        return u
-    if u.startswith("git@github.com"):
-        u = removeprefix(u, "git@")
-        u = removesuffix(u, ".git")
-        u = u.replace(":", "/", 1)
-        return "https://" + u
-    # TODO: make this configurable
-    if u.startswith("https://go.googlesource.com/"):
-        return u.replace(
-            "https://go.googlesource.com/", "https://github.com/golang/", 1
-        )
+    u = _normalize_remote(u)
     if replacements:
-        for k, v in replacements.items():
-            if u.startswith(k):
-                return u.replace(k, v, 1)
+        return _convert_remote_url(u, replacements)
+    return convert_remote_url_cached(u)
+
+
+# convert_remote_url_cached is convert_remote_url for URLs that have already
+# been normalized with _normalize_remote.
+@functools.lru_cache(maxsize=64)
+def convert_remote_url_cached(u_norm: str) -> str:
+    return _convert_remote_url(u_norm)
+
+
+def _convert_remote_url(u: str, replacements: Optional[Dict[str, str]] = None) -> str:
+    m = _REMOTE_REWRITE_RE.match(u)
+    if m:
+        return _REMOTE_HANDLERS[m.group(1)](u)
+    if replacements:
+        m = _replacements_re(tuple(sorted(replacements.items()))).match(u)
+        if m:
+            return replacements[m.group(1)] + u[m.end() :]
     raise UnsupportedURIException(u)
 
 
-def view_row(view: sublime.View, point: int) -> int:
-    return 0
+def _github_ssh_url(u: str) -> str:
+    return "https://" + removeprefix(u, "git@").replace(":", "/", 1)
+
+
+def _prefix_re(prefixes: Iterable[str]) -> Pattern[str]:
+    # Try longer prefixes first so that the most specific prefix wins.
+    prefixes = sorted(prefixes, key=len, reverse=True)
+    return re.compile("^(" + "|".join(map(re.escape, prefixes)) + ")")
+
+
+# Remote URL prefix => function that converts remote URLs with that prefix
+_REMOTE_HANDLERS: Dict[str, Callable[[str], str]] = {
+    "https://github.com": lambda u: u,
+    "git@github.com": _github_ssh_url,
+    # TODO: make this configurable
+    "https://go.googlesource.com/": lambda u: (
+        "https://github.com/golang/" + removeprefix(u, "https://go.googlesource.com/")
+    ),
+}
+
+_REMOTE_REWRITE_RE = _prefix_re(_REMOTE_HANDLERS)
+
+
+@functools.lru_cache(maxsize=8)
+def _replacements_re(replacements: Tuple[Tuple[str, str], ...]) -> Pattern[str]:
+    return _prefix_re(k for k, _ in replacements)
 
 
 def view_selection_rows(view: sublime.View) -> Optional[RowRange]:
@@ -158,24 +362,25 @@ def view_selection_rows(view: sublime.View) -> Optional[RowRange]:
     return None
 
 
+# _git_dir returns path if it is a directory, otherwise its parent directory.
+@functools.lru_cache(maxsize=256)
+def _git_dir(path: str) -> str:
+    return path if isdir(path) else dirname(path)
+
+
 def _git(path: str, *cmd: str) -> str:
-    if not isdir(path):
-        path = dirname(path)
     try:
         proc = subprocess.run(
-            ["git", "-C", path, *cmd],
-            capture_output=True,
+            ["git", "-C", _git_dir(path), *cmd],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             check=True,
             timeout=5,
-            encoding="utf-8",
         )
-        if proc.stdout:
-            return proc.stdout.strip()
-        else:
-            return ""
+        return proc.stdout.decode("utf-8", "replace").strip()
     except subprocess.CalledProcessError as e:
-        stdout = e.stdout.decode().strip() if e.stdout else "<NONE>"
-        stderr = e.stderr.decode().strip() if e.stderr else "<NONE>"
+        stdout = e.stdout.decode("utf-8", "replace").strip() if e.stdout else "<NONE>"
+        stderr = e.stderr.decode("utf-8", "replace").strip() if e.stderr else "<NONE>"
         log.warn(
             "command %s exited with %d\nstdout:\n%s\nstderr:\n%s",
             e.cmd,
@@ -186,43 +391,179 @@ def _git(path: str, *cmd: str) -> str:
         raise e
 
 
-def git_top_level(path: str) -> str:
-    return _git(path, "rev-parse", "--show-toplevel")
+# _git_batch returns the top-level directory, current commit and abbreviated
+# branch name ("HEAD" if detached) of the repo containing path using a single
+# git invocation.
+def _git_batch(path: str) -> Dict[str, str]:
+    # NB: "--abbrev-ref" applies to all following revisions so the full
+    # commit SHA must be requested first.
+    top_level, commit, branch = _git(
+        path, "rev-parse", "--show-toplevel", "HEAD", "--abbrev-ref", "HEAD"
+    ).splitlines()
+    return {"top_level": top_level, "commit": commit, "branch": branch}
 
 
-def git_commit_sha(path: str) -> str:
-    return _git(path, "rev-parse", "HEAD")
+# _git_config returns all of the "branch.*" and "remote.*" config entries of
+# the repo containing path using a single git invocation.
+def _git_config(path: str) -> Dict[str, str]:
+    try:
+        out = _git(path, "config", "--get-regexp", r"^(branch|remote)\.")
+    except subprocess.CalledProcessError:
+        # git exits 1 if there are no matching keys
+        return {}
+    config: Dict[str, str] = {}
+    for line in out.splitlines():
+        key, _, value = line.partition(" ")
+        config[key] = value
+    return config
+
+
+# _config_remote_url returns the URL of the remote of branch using the config
+# returned by _git_config.
+def _config_remote_url(config: Dict[str, str], branch: str) -> Optional[str]:
+    remotes = [k for k in config if k.startswith("remote.") and k.endswith(".url")]
+    if len(remotes) == 1:
+        return config[remotes[0]]
+    # TODO: not all branches have a remote configured
+    # so we need a better way to figure this out.
+    remote = config.get(f"branch.{branch}.remote")
+    if remote:
+        return config.get(f"remote.{remote}.url")
+    return None
 
 
-def git_detached_head(path: str) -> bool:
-    try:
-        proc = subprocess.run(
-            ["git", "-C", path, "symbolic-ref", "--quiet", "HEAD"],
-            check=True,
-            timeout=5,
+# resolve_branch_remote returns the branch to browse and its remote URL,
+# config is the output of _git_config.
+def resolve_branch_remote(
+    path: str, branch: str, config: Dict[str, str]
+) -> Optional[Tuple[str, str]]:
+    if branch == "HEAD":
+        # Detached HEAD: fallback to the slower branch resolution.
+        branch = git_detached_branch(path)
+    remote = _config_remote_url(config, branch)
+    if not remote:
+        resolved = git_commit_branch(path, branch)
+        if not resolved:
+            log.info("failed to find a branch for commit %s", branch)
+            return None
+        branch, remote_name = resolved
+        remote = config.get(f"remote.{remote_name}.url")
+        if not remote:
+            log.info("failed to find a remote for commit %s", branch)
+            return None
+    return branch, remote
+
+
+# _BatchCheck is a long-running "git cat-file --batch-check" process that is
+# used to resolve revisions without spawning git for each query.
+class _BatchCheck:
+    __slots__ = "proc", "lock", "lines", "head_mtime"
+
+    def __init__(self, top_level: str, head_mtime: int) -> None:
+        self.proc = subprocess.Popen(
+            ["git", "-C", top_level, "cat-file", "--batch-check=%(objectname)"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
         )
-        return False
-    except subprocess.CalledProcessError:
-        return True
+        self.lock = threading.Lock()
+        # Output is read by a separate thread so that resolve can time out
+        # (selectors does not support pipes on Windows).
+        self.lines: "queue.Queue[bytes]" = queue.Queue()
+        self.head_mtime = head_mtime
+        threading.Thread(
+            target=self._read_lines, name="GitTools cat-file", daemon=True
+        ).start()
+
+    def _read_lines(self) -> None:
+        assert self.proc.stdout
+        for line in iter(self.proc.stdout.readline, b""):
+            self.lines.put(line)
+        self.lines.put(b"")  # EOF
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    # resolve raises TimeoutError if cat-file does not respond in time, the
+    # process should then be closed.
+    def resolve(self, rev: str) -> Optional[str]:
+        assert self.proc.stdin
+        with self.lock:
+            self.proc.stdin.write(rev.encode("utf-8") + b"\n")
+            self.proc.stdin.flush()
+            try:
+                out = self.lines.get(timeout=5)
+            except queue.Empty:
+                raise TimeoutError(f"timed out resolving: {rev}")
+        line = out.decode("utf-8", "replace").strip()
+        # Unknown revisions are reported as "REV missing" or "REV ambiguous"
+        # and an empty line means that the process exited.
+        if not line or " " in line:
+            return None
+        return line
+
+    def close(self) -> None:
+        self.proc.kill()
+        self.proc.wait()
+
+
+# Maximum number of _BatchCheck processes to keep running
+_MAX_BATCH_CHECKS = 8
+
+# Map of repo top-level => _BatchCheck
+_BATCH_CHECKS: Dict[str, _BatchCheck] = {}
 
 
-def git_branch(path: str) -> str:
+# _batch_rev_parse resolves rev in the repo at top_level to a commit SHA
+# using a _BatchCheck process. None is returned if rev could not be resolved
+# this way, in which case callers should fallback to running git.
+def _batch_rev_parse(top_level: str, rev: str) -> Optional[str]:
+    try:
+        head_mtime = os.stat(join(top_level, ".git", "HEAD")).st_mtime_ns
+    except OSError:
+        return None
+    bc = _BATCH_CHECKS.pop(top_level, None)
+    if bc is not None and (not bc.alive() or bc.head_mtime != head_mtime):
+        bc.close()
+        bc = None
+    try:
+        if bc is None:
+            bc = _BatchCheck(top_level, head_mtime)
+        sha = bc.resolve(rev)
+    except OSError as e:  # includes TimeoutError
+        log.warning("git cat-file: %s", e)
+        if bc is not None:
+            bc.close()
+        return None
+    # Re-insert so that the least recently used process is evicted first.
+    _BATCH_CHECKS[top_level] = bc
+    while len(_BATCH_CHECKS) > _MAX_BATCH_CHECKS:
+        _BATCH_CHECKS.pop(next(iter(_BATCH_CHECKS))).close()
+    return sha
+
+
+def _close_batch_checks() -> None:
+    while _BATCH_CHECKS:
+        _BATCH_CHECKS.popitem()[1].close()
+
+
+def git_commit_sha(path: str) -> str:
+    return _git(path, "rev-parse", "HEAD")
+
+
+# git_detached_branch returns the name of the branch or tag that contains the
+# current commit, or its SHA if there is none. It should only be used when
+# HEAD is detached (the current branch is reported by _git_batch).
+def git_detached_branch(path: str) -> str:
     try:
-        branch = _git(path, "rev-parse", "--abbrev-ref", "HEAD")
-        if branch != "HEAD":
-            return branch
-        # Check if were detached
-        if git_detached_head(path):
-            return git_commit_sha(path)
         branch = _git(path, "name-rev", "--name-only", "HEAD")
-        if branch != "HEAD":
+        # Ignore relative names like "master~2" and commits without a name.
+        if branch != "undefined" and "~" not in branch and "^" not in branch:
             if branch.startswith("tags/"):
                 return removeprefix(branch, "tags/")
             elif branch.startswith("remotes/"):
                 if branch.count("/") > 2:
                     return "/".join(branch.split("/")[2:])
-                else:
-                    return git_commit_sha(path)
             else:
                 return branch
     except subprocess.CalledProcessError:
@@ -231,65 +572,57 @@ def git_branch(path: str) -> str:
 
 
 # WARN: this should probably only be used if we're in a detached state.
-# git_commit_branch returns the branch that a git commit belongs.
-def git_commit_branch(path: str, commit: str) -> Optional[str]:
-    # TODO: see if we can use the "/remotes/*" result
-    # Example output:
-    #     * cev/fixes
-    #     remotes/charlievieth/cev/fixes
+# git_commit_branch returns the name of a remote branch that contains a git
+# commit and the name of its remote. Local branches are reported by the name
+# of the branch they track on the remote.
+def git_commit_branch(path: str, commit: str) -> Optional[Tuple[str, str]]:
+    # Example output (the current branch is marked with "*" and is followed
+    # by the name of the remote it tracks and its upstream ref, if any):
+    #     refs/heads/cev/fixes\t*charlievieth\trefs/remotes/charlievieth/fixes
+    #     refs/remotes/charlievieth/cev/fixes\t \t
     try:
-        branches = _git(
-            path, "branch", "--all", "--no-color", "--contains", commit
+        refs = _git(
+            path,
+            "for-each-ref",
+            "--contains",
+            commit,
+            "--format=%(refname)\t%(HEAD)%(upstream:remotename)\t%(upstream)",
+            "refs/heads",
+            "refs/remotes",
         ).splitlines()
-        if not branches:
-            return None
     except subprocess.CalledProcessError:
         return None
 
-    # Try to find the current branch. Since this function should only
-    # be used when we're in a detached state this should fail.
-    for b in branches:
-        if b.startswith("* ") and "HEAD detached at" not in b:
-            return removeprefix(b, "* ")
-
-    # Try to find a preferred branch that contains the commit.
-    branches = [b.strip() for b in branches]
-    for b in PREFERRED_BRANCHES:
-        if b in branches:
-            return b
-
-    # Try to find a branch with a remote URL
-    for b in sorted(branches):
-        try:
-            remote = _git(path, "config", f"branch.{b}.remote")
-            if _git(path, "config", f"remote.{remote}.url"):
-                return b
-        except subprocess.CalledProcessError:
-            pass
-
-    return None
-
-
-def git_remotes(path: str) -> List[str]:
-    return _git(path, "remote", "show").splitlines()
-
-
-# WARN: use or remove
-def git_branch_remote_url(path: str, branch: str) -> Optional[str]:
-    remotes = git_remotes(path)
-    if len(remotes) == 1:
-        return _git(path, "config", "get", f"remote.{remotes[0]}.url")
-    # TODO: not all branches have a remote configured
-    # so we need a better way to figure this out.
-    try:
-        remote = _git(path, "config", "get", f"branch.{branch}.remote")
-        if remote:
-            return _git(path, "config", "get", f"remote.{remote}.url")
+    # Rank branches with a remote by: the current branch (since this function
+    # should only be used when we're in a detached state this should fail),
+    # then the preferred branches and then by name.
+    best: Optional[Tuple[Tuple[int, int, str], str, str]] = None
+    for line in refs:
+        ref, _, rest = line.partition("\t")
+        tracking, _, upstream = rest.partition("\t")
+        head, remote = tracking[:1], tracking[1:]
+        if ref.startswith("refs/remotes/"):
+            name = ref[len("refs/remotes/") :]
+            remote, _, branch = name.partition("/")
+            if branch == "HEAD":
+                continue
         else:
-            return ""
-    except subprocess.CalledProcessError:
+            name = ref[len("refs/heads/") :]
+            # Use the name of the branch on the remote, which may differ
+            # from the local name (e.g. "feat" tracking "origin/main").
+            prefix = f"refs/remotes/{remote}/"
+            if not remote or not upstream.startswith(prefix):
+                continue
+            branch = upstream[len(prefix) :]
+        preferred = _PREFERRED_RANK.get(name, len(PREFERRED_BRANCHES))
+        rank = (0 if head == "*" else 1, preferred, name)
+        if best is None or rank < best[0]:
+            best = (rank, branch, remote)
+
+    if best is None:
         return None
+    return best[1], best[2]
 
 
-def repo_relpath(path: str) -> str:
-    return relpath(path, git_top_level(path))
+def repo_relpath(path: str, top_level: str) -> str:
+    return relpath(path, top_level)